@@ -15,16 +15,23 @@ do monthly analysis, where it analyzes message data based on month, or yearly
 analysis of similar function.
 '''
 import argparse as ap
-import json
 import sys
 import os
+import re
 from glob import glob
+from itertools import chain
 from operator import itemgetter
-from functools import reduce
+from multiprocessing import Pool
 from datetime import datetime
 from os.path import basename, join, exists
 from emoji import UNICODE_EMOJI
 
+try:
+    # Much faster at parsing large message logs, but entirely optional
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 DATA_COLLECTED = {'msgs_sent': 'Messages sent',
                   'avg_msg_len': 'Avg message length',
                   'photos_sent': 'Photos sent',
@@ -36,6 +43,43 @@ DATA_COLLECTED = {'msgs_sent': 'Messages sent',
 
 INTERVALS = ['hourly', 'monthly', 'yearly']
 
+# The conversation title comes right after the list of messages, near the end of
+# message.json, so looking at the last few bytes is usually enough to find it
+TITLE_RE = re.compile(rb'\]\s*,\s*"title"\s*:\s*("(?:[^"\\]|\\.)*")')
+TITLE_TAIL_SIZE = 4096
+
+# Turns a local datetime into the interval it belongs to
+INTERVAL_FORMATS = {'hourly': lambda stamp: stamp.hour,
+                    'monthly': lambda stamp: '%d-%02d' % (stamp.year, stamp.month),
+                    'yearly': lambda stamp: str(stamp.year)}
+
+# Time zone offsets and DST changes all sit on 15 minute boundaries, so every
+# timestamp within one of these slices has the same local hour
+INTERVAL_SLICE_MS = 15 * 60 * 1000
+
+def _codepoint_ranges(chars, gap):
+    '''
+    Returns a list of (first, last) character ranges covering all the given
+    characters, merging those less than `gap` codepoints apart.
+    '''
+    ranges = []
+    for c in sorted(map(ord, chars)):
+        if ranges and c - ranges[-1][1] <= gap:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+
+    return [(chr(first), chr(last)) for first, last in ranges]
+
+# Every single-codepoint emoji, built once at import for fast membership tests
+EMOJI_SET = frozenset(e for e in UNICODE_EMOJI if len(e) == 1)
+
+# A handful of coarse ranges holding every emoji above. Searching for these
+# stops at the first hit, and rules out most non-ASCII text (accents, Cyrillic,
+# etc.) much faster than checking every character against EMOJI_SET
+EMOJI_RANGES_RE = re.compile('[%s]' % ''.join('%s-%s' % (re.escape(first), re.escape(last))
+                                              for first, last in _codepoint_ranges(EMOJI_SET, 256)))
+
 def get_args():
     '''
     Gets all command-line arguments
@@ -46,6 +90,7 @@ def get_args():
     parser.add_argument('folder', type=str, help='Folder to FB messages')
     parser.add_argument('-t', '--interval', default='hourly', type=str, choices=INTERVALS, help='Time interval for analysis')
     parser.add_argument('--threshold', default=10, type=int, help='Conversations below this will be ignored')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of conversations analyzed at once with --all (defaults to number of CPUs)')
 
     manual_group = parser.add_mutually_exclusive_group()
     manual_group.add_argument('-l', '--limit', type=int, default=5, help='Limit to relevant groups')
@@ -58,6 +103,30 @@ def get_args():
 
     return parser.parse_args()
 
+def load_json(path):
+    '''
+    Returns the parsed contents of the given JSON file.
+    '''
+    with open(path, 'rb') as fp:
+        return json_loads(fp.read())
+
+def get_title(folder):
+    '''
+    Returns the title of the conversation in the given folder, without parsing
+    the whole message.json file if possible.
+    '''
+    msg_json_path = join(folder, 'message.json')
+    with open(msg_json_path, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        fp.seek(max(0, fp.tell() - TITLE_TAIL_SIZE))
+        tail = fp.read()
+
+    matches = TITLE_RE.findall(tail)
+    if matches:
+        return json_loads(matches[-1])
+    # Odd layout or an unusually long title; do it the slow way
+    return load_json(msg_json_path)['title']
+
 def get_relevant_msg_folders(root):
     '''
     Given the name of the root folder, gets the list of relevant folders that
@@ -66,21 +135,24 @@ def get_relevant_msg_folders(root):
     folders = glob(join(root, 'messages', '*'))
     return filter(lambda f: basename(f).islower(), folders)
 
-def score_relevance(folder, s):
+def score_relevance(folder, parts):
     '''
-    Given the name of the group, returns a score where the higher the score the
-    more relevant the folder is to the group. A score of 0 means no relevancy.
+    Given the parts of the (lowercased) name of the group, returns a score where
+    the higher the score the more relevant the folder is to the group. A score
+    of 0 means no relevancy.
     '''
-    parts = s.lower().split(' ')
-    return reduce(lambda a, part: a + int(part in folder), parts, 0)
+    return sum(part in folder for part in parts)
 
 def get_relevant_people_folders(folders, s):
     '''
     Given a list of folders and the name of the person, returns all folders
     relevant, in descending order of relevancy
     '''
-    rels = filter(lambda f: score_relevance(f, s) > 0, folders)
-    return sorted(rels, key=lambda f: score_relevance(f, s), reverse=True)
+    # Split the name only once, and score each folder only once
+    parts = s.lower().split(' ')
+    scores = [(f, score_relevance(f, parts)) for f in folders]
+    rels = filter(lambda fs: fs[1] > 0, scores)
+    return [f for f, _ in sorted(rels, key=itemgetter(1), reverse=True)]
 
 def select_relevant_convo(relevants):
     '''
@@ -92,9 +164,7 @@ def select_relevant_convo(relevants):
     '''
     # Make them look a bit prettier, first of all
     for i, folder in enumerate(relevants):
-        # Opens the files to read the title
-        msgs = json.load(open(join(folder, 'message.json')))
-        print('[%d]\t%s' % (i, msgs['title']))
+        print('[%d]\t%s' % (i, get_title(folder)))
 
     try:
         u = int(input('Enter index [0-%d]: ' % (len(relevants) - 1)))
@@ -109,27 +179,34 @@ def _create_stats():
     '''
     Returns a sub-statistics profile
     '''
-    return {k: 0 for k in DATA_COLLECTED.keys()}
+    return dict.fromkeys(DATA_COLLECTED, 0)
 
-def create_stats(args):
+def create_stats():
     '''
     Returns a blank statistics profile, preferably for an interlocutor.
+
+    Interval statistics are only added once the interval is actually seen, no
+    matter what kind of interval it is.
     '''
     general = _create_stats()
+    general['int'] = {}
 
-    if args.interval == 'hourly':
-        general['int'] = {hr: _create_stats() for hr in range(24)}
-    elif args.interval == 'monthly' or args.interval == 'yearly':
-        general['int'] = {}
-
-    return dict(general)
+    return general
 
 def count_emoji(s):
     '''
     Returns the number of emoji used in a string.
     '''
+    # Most messages are plain ASCII, which can't contain any actual emoji
+    if s.isascii():
+        return s.count('\\u') // 4
+
     unorthodox_counting = s.count('\\u') // 4
-    orthodox_counting = reduce(lambda a, c: a + int(c in UNICODE_EMOJI.keys()), s, 0)
+    # Only look at every character if there could be any emoji at all
+    if not EMOJI_RANGES_RE.search(s):
+        return unorthodox_counting
+
+    orthodox_counting = sum(c in EMOJI_SET for c in s)
 
     return unorthodox_counting + orthodox_counting
 
@@ -137,150 +214,150 @@ def is_gif(p):
     '''
     Returns true if the given photo (p['uri']) is a GIF
     '''
-    return '.gif' in p['uri']
+    return p['uri'].endswith('.gif')
 
-def get_property(stats, prop, t=str):
+def get_property(stats, participants, prop, t=str):
     '''
     Returns a list of properties from the stats dictionary format mentioned
-    above.
+    above, in order of participants.
     '''
-    participants = list(filter(lambda name: name != 'intervals', stats.keys()))
-
     return map(t, map(itemgetter(prop), map(lambda p: stats[p], participants)))
 
-def get_interval_tsv(stats, interval):
+def get_interval_tsv(stats, participants, interval):
     '''
     Returns TSV string of statistics based on interval given
     '''
-    participants = list(filter(lambda name: name != 'intervals', stats.keys()))
-
-    # Returns a dictionary of statistics of a given person by interval
-    get_person_stats = lambda p: stats[p]['int'].get(interval, _create_stats())
-    # Returns a list of keys of statistics of a given person by interval
-    get_person_keys = lambda p: get_person_stats(p).keys()
+    # People who sent nothing in this interval get all zeroes
+    blank = _create_stats()
     # Returns a TSV string of statistics of a given person, in order of keys
-    get_combined_stats = lambda p: '\t'.join(map(lambda k: str(get_person_stats(p)[k]), get_person_keys(p)))
+    get_combined_stats = lambda p: '\t'.join(map(str, stats[p]['int'].get(interval, blank).values()))
 
     return '\t'.join(map(get_combined_stats, participants))
 
-def print_general_stats(stats, where):
+def get_general_stats_lines(stats, participants):
     '''
-    Prints all general statistics in TSV.
+    Returns a list of all general statistics, each line in TSV.
     '''
+    return ['%s\t%s' % (v, '\t'.join(get_property(stats, participants, k)))
+            for k, v in DATA_COLLECTED.items()]
 
-    for k, v in DATA_COLLECTED.items():
-        print('%s\t%s' % (v, '\t'.join(get_property(stats, k))), file=where)
-
-def print_interval_stats(stats, interval, where):
+def get_interval_stats_lines(stats, participants, intervals, interval):
     '''
-    Prints the statistics based on hourly, monthly, or yearly intervals
+    Returns a list of the statistics based on hourly, monthly, or yearly
+    intervals, each line in TSV. The monthly and yearly intervals are listed in
+    the order given.
     '''
     if interval == 'hourly':
-        for hr in range(24):
-            print('%d\t%s' % (hr, get_interval_tsv(stats, hr)), file=where)
+        return ['%d\t%s' % (hr, get_interval_tsv(stats, participants, hr))
+                for hr in range(24)]
     elif interval == 'monthly' or interval == 'yearly':
-        for interval in stats['intervals']:
-            print('%s\t%s' % (interval, get_interval_tsv(stats, interval)), file=where)
+        return ['%s\t%s' % (i, get_interval_tsv(stats, participants, i))
+                for i in intervals]
 
-def pretty_print_stats(stats, args, where=None):
+def pretty_print_stats(stats, intervals, args, where=None):
     '''
-    Prints the statistics prettily
+    Prints the statistics prettily, given the statistics of every participant
+    and the intervals seen
     '''
-    if where is None:
-        where = sys.stdout
-    else:
-        where = open(where, 'w')
+    participants = list(stats.keys())
+    ksizes = len(DATA_COLLECTED.keys())
 
-    participants = list(filter(lambda name: name != 'intervals', stats.keys()))
+    # Everything is put together first, then written out in one go
+    lines = []
     # Some general informations
-    print('Total Messages sent\t%d' % sum(get_property(stats, 'msgs_sent', t=int)), file=where)
-    print('Participants\t%s' % '\t'.join(participants), file=where)
+    lines.append('Total Messages sent\t%d' % sum(get_property(stats, participants, 'msgs_sent', t=int)))
+    lines.append('Participants\t%s' % '\t'.join(participants))
 
-    print(file=where)
-    print_general_stats(stats, where)
-    print(file=where)
+    lines.append('')
+    lines.extend(get_general_stats_lines(stats, participants))
+    lines.append('')
 
     # Interval statistics
-    ksizes = len(DATA_COLLECTED.keys())
-    print('Order\t%s' % ''.join(map(lambda p: (p + '\t') * ksizes,
-        participants)), file=where)
-    print('Interval\t%s' % '\t'.join(list(DATA_COLLECTED.keys()) *
-        len(participants)), file=where)
-    print_interval_stats(stats, args.interval, where)
+    lines.append('Order\t%s' % ''.join(map(lambda p: (p + '\t') * ksizes,
+        participants)))
+    lines.append('Interval\t%s' % '\t'.join(list(DATA_COLLECTED.keys()) *
+        len(participants)))
+    lines.extend(get_interval_stats_lines(stats, participants, intervals, args.interval))
+
+    output = '\n'.join(lines) + '\n'
+    if where is None:
+        sys.stdout.write(output)
+    else:
+        with open(where, 'w') as fp:
+            fp.write(output)
 
-    # Good manners
-    if where != sys.stdout:
-        where.close()
+def get_interval_getter(args):
+    '''
+    Returns a function that gives the correct interval of a timestamp (in
+    milliseconds), based on the arguments (only interval is required).
 
-def get_correct_interval(stamp, args):
+    The interval format is picked once here rather than for every message, and
+    results are memoized, as consecutive messages tend to share an interval.
     '''
-    Returns the correct interval given the timestamp and the arguments (only
-    interval is required).
+    to_interval = INTERVAL_FORMATS[args.interval]
+    memo = {}
+
+    def get_interval(ts):
+        # Every timestamp in the same slice falls into the same interval
+        key = int(ts) // INTERVAL_SLICE_MS
+        if key not in memo:
+            stamp = datetime.fromtimestamp(key * INTERVAL_SLICE_MS / 1e3)
+            memo[key] = to_interval(stamp)
+        return memo[key]
+
+    return get_interval
+
+def get_records(messages):
     '''
-    if args.interval == 'hourly':
-        return stamp.hour
-    elif args.interval == 'monthly':
-        return '%d-%02d' % (stamp.year, stamp.month)
-    elif args.interval == 'yearly':
-        return str(stamp.year)
+    Returns every message as a slim tuple of (sender, timestamp, content,
+    photos, gifs, videos, reactions, share), with missing fields as `None`.
+    Messages without a sender are generated, and are left out.
+    '''
+    return ((m['sender_name'], m['timestamp_ms'], m.get('content'),
+             m.get('photos'), m.get('gifs'), m.get('videos'),
+             m.get('reactions'), m.get('share'))
+            for m in messages if m.get('sender_name'))
 
-def handle_content(stats, interval, msg):
+def handle_content(bucket, content):
     '''
     Handles all messages with content
     '''
-    name = msg['sender_name']
-    emojis = count_emoji(msg['content'])
-
-    stats[name]['msgs_sent'] += 1
-    stats[name]['avg_msg_len'] += len(msg['content'])
-    stats[name]['emojis_sent'] += emojis
-    stats[name]['int'][interval]['msgs_sent'] += 1
-    stats[name]['int'][interval]['avg_msg_len'] += len(msg['content'])
-    stats[name]['int'][interval]['emojis_sent'] += emojis
+    bucket['msgs_sent'] += 1
+    bucket['avg_msg_len'] += len(content)
+    bucket['emojis_sent'] += count_emoji(content)
 
-def handle_photos_and_gifs(stats, interval, msg):
+def handle_photos_and_gifs(bucket, photo_list, gif_list):
     '''
     Handles all instances of messages with photos or GIFs
     '''
-    name = msg['sender_name']
     photos = 0
     gifs = 0
-    for p in msg.get('photos', []) + msg.get('gifs', []):
+    for p in chain(photo_list or (), gif_list or ()):
         if is_gif(p):
             gifs += 1
         else:
             photos += 1
 
-    stats[name]['photos_sent'] += photos
-    stats[name]['gifs_sent'] += gifs
-    stats[name]['int'][interval]['photos_sent'] += photos
-    stats[name]['int'][interval]['gifs_sent'] += gifs
+    bucket['photos_sent'] += photos
+    bucket['gifs_sent'] += gifs
 
-def handle_videos(stats, interval, msg):
+def handle_videos(bucket, videos):
     '''
     Handles all messages with video content
     '''
-    name = msg['sender_name']
-
-    stats[name]['vids_sent'] += len(msg['videos'])
-    stats[name]['int'][interval]['vids_sent'] += len(msg['videos'])
+    bucket['vids_sent'] += len(videos)
 
-def handle_links(stats, interval, msg):
+def handle_links(bucket):
     '''
     Handles all messages with links
     '''
-    name = msg['sender_name']
+    bucket['links_sent'] += 1
 
-    stats[name]['links_sent'] += 1
-    stats[name]['int'][interval]['links_sent'] += 1
-
-def handle_reactions(stats, interval, msg):
+def handle_reactions(stats, interval, reactions):
     '''
     Handles all messages with reactions
     '''
-    name = msg['sender_name']
-
-    for rs in msg['reactions']:
+    for rs in reactions:
         # Sometimes, there is no actor for some odd reason
         # I'm guessing that the user deleted their (her) FB account, thus making
         # it come up blank
@@ -292,9 +369,28 @@ def handle_reactions(stats, interval, msg):
             # Add the keys if they don't already exist
             stats[actor]['int'][interval] = _create_stats()
 
-        stats[actor]['reactions'] += 1
         stats[actor]['int'][interval]['reactions'] += 1
 
+def average_msg_len(profile):
+    '''
+    Turns the total message length of a statistics profile into the average.
+    '''
+    if profile['msgs_sent'] > 0:
+        profile['avg_msg_len'] /= profile['msgs_sent']
+
+def finalize_stats(person):
+    '''
+    Fills in the general statistics of a person by adding up all of their
+    interval statistics, and averages out all of their message lengths, in a
+    single pass over the intervals.
+    '''
+    for bucket in person['int'].values():
+        for k in DATA_COLLECTED:
+            person[k] += bucket[k]
+        average_msg_len(bucket)
+
+    average_msg_len(person)
+
 def analyze(folder, args, where=None):
     '''
     Given the folder of the conversation to analyze, prints out (in TSV format)
@@ -304,69 +400,66 @@ def analyze(folder, args, where=None):
     msg_json_path = join(folder, 'message.json')
     if not exists(msg_json_path): return False
 
-    # First, do a bit of processing on the JSON (now python dict), because if
-    # you don't, there will be a lot of duplicated code.
-    with open(msg_json_path, 'r') as fp:
-        convo = json.load(fp)
-        # Adds 'timestamp' into the dict, for each and every one of them
-        for i in range(len(convo['messages'])):
-            ts = convo['messages'][i]['timestamp_ms']
-            ts = datetime.fromtimestamp(int(ts) / 1e3)
-            convo['messages'][i]['timestamp'] = ts
-
-    # Threshold checking
+    convo = load_json(msg_json_path)
+
+    # Threshold checking, before any per-message work is done
     if len(convo['messages']) <= args.threshold:
         return False
 
+    get_interval = get_interval_getter(args)
+
     # Now, let's have fun.
-    stats = {p['name']: create_stats(args) for p in convo['participants']}
-    stats['intervals'] = []
+    stats = {p['name']: create_stats() for p in convo['participants']}
+    # Every interval seen, in order, and the same as a set for quick checks
+    intervals = []
+    seen_intervals = set()
 
-    for msg in convo['messages']:
-        # Some messages are generated; ignore them
-        if not msg.get('sender_name'): continue
-        # Calculate the interval first
-        interval = get_correct_interval(msg['timestamp'], args)
-        name = msg['sender_name']
+    for name, ts, content, photos, gifs, videos, reactions, share in get_records(convo['messages']):
+        # Calculate the interval first, straight from the raw timestamp
+        interval = get_interval(ts)
 
         # Sometimes, the names disappear from the participants
         # Just add them in if they don't exist again
         if name not in stats:
-            stats[name] = create_stats(args)
+            stats[name] = create_stats()
 
-        if interval not in stats['intervals']:
+        if interval not in seen_intervals:
             # Add interval for quick reference later
-            stats['intervals'].append(interval)
+            seen_intervals.add(interval)
+            intervals.append(interval)
         if interval not in stats[name]['int']:
             # Add the keys if they don't already exist
             stats[name]['int'][interval] = _create_stats()
 
-        if msg.get('content'):
-            handle_content(stats, interval, msg)
-        if msg.get('photos') or msg.get('gifs'):
-            handle_photos_and_gifs(stats, interval, msg)
-        if msg.get('videos'):
-            handle_videos(stats, interval, msg)
-        if msg.get('reactions'):
-            handle_reactions(stats, interval, msg)
-        if msg.get('share'):
-            handle_links(stats, interval, msg)
-
-    # Average out the average messages, actually
-    for name in stats.keys():
-        # Only names, please....
-        if name == 'intervals': continue
-
-        if stats[name]['avg_msg_len'] > 0:
-            stats[name]['avg_msg_len'] /= stats[name]['msgs_sent']
-
-        for interval in stats[name]['int'].keys():
-            if stats[name]['int'][interval]['msgs_sent'] > 0:
-                stats[name]['int'][interval]['avg_msg_len'] /= stats[name]['int'][interval]['msgs_sent']
-
-    pretty_print_stats(stats, args, where)
+        # Only the interval statistics are counted per message; the general
+        # statistics are added up from them afterwards
+        bucket = stats[name]['int'][interval]
+
+        if content:
+            handle_content(bucket, content)
+        if photos or gifs:
+            handle_photos_and_gifs(bucket, photos, gifs)
+        if videos:
+            handle_videos(bucket, videos)
+        if reactions:
+            handle_reactions(stats, interval, reactions)
+        if share:
+            handle_links(bucket)
+
+    # Add everything up and average out the average messages, actually
+    for person in stats.values():
+        finalize_stats(person)
+
+    pretty_print_stats(stats, intervals, args, where)
     return True
 
+def analyze_star(job):
+    '''
+    Unpacks the arguments for `analyze`, so that it can be used with
+    `Pool.imap`.
+    '''
+    return analyze(*job)
+
 def main():
     '''
     Main function. Linter please shut up.
@@ -410,11 +503,15 @@ def main():
         if not exists(folder_name):
             os.makedirs(folder_name)
 
-        for i, convo in enumerate(convos, 1):
-            filename = join(folder_name, basename(convo) + '.tsv')
-            name = basename(convo).split('_')[0]
-            print('(%04d/%04d) %s' % (i, len(convos), name), end='')
-            print('...Ok' if analyze(convo, args, filename) else '...Fail')
+        # Every conversation is independent, so analyze them in parallel
+        jobs = [(convo, args, join(folder_name, basename(convo) + '.tsv'))
+                for convo in convos]
+        with Pool(args.jobs) as pool:
+            results = pool.imap(analyze_star, jobs)
+            for i, (convo, ok) in enumerate(zip(convos, results), 1):
+                name = basename(convo).split('_')[0]
+                print('(%04d/%04d) %s' % (i, len(convos), name), end='')
+                print('...Ok' if ok else '...Fail')
 
 if __name__ == '__main__':
     main()